@@ -16,9 +16,39 @@ DATA_DIR = os.path.join(OUTPUT_DIR, "data")
 PATH_TO_DATA = r"D:\Academic\MD Research 2025\raw data\2026_januaryPrescriptions_pseudonymised.csv"
 
 # Intermediate data paths
-ENCOUNTER_CLEAN_PATH = os.path.join(DATA_DIR, "encounter_level_clean.csv")
-ENCOUNTER_PRESCRIBER_PATH = os.path.join(DATA_DIR, "encounter_level_with_prescriber.csv")
+ENCOUNTER_CLEAN_PATH = os.path.join(DATA_DIR, "encounter_level_clean.parquet")
+ENCOUNTER_PRESCRIBER_PATH = os.path.join(DATA_DIR, "encounter_level_with_prescriber.parquet")
 ENCOUNTER_CLUSTERED_PATH = os.path.join(DATA_DIR, "encounter_level_clustered.csv")
+FEATURE_MATRIX_CACHE_PATH = os.path.join(DATA_DIR, "feature_matrix.pkl")
+
+# ============================================================
+# RAW DATA SCHEMA
+# ============================================================
+
+# Explicit dtypes for the raw extract (skips pandas type inference).
+# Both pseudonymised and plain ID column names are listed; whichever
+# the extract contains is used.
+DTYPES = {
+    "patient_pseudo_id": "category",
+    "prescriber_pseudo_id": "category",
+    "patient_id": "category",
+    "prescriber_id": "category",
+    "age_months": "Int16",
+    "age_stratum": "category",
+    "Gender": "category",
+    "VisitType": "category",
+    "PatientWeight": "float32",
+    "num_distinct_drugs": "Int8",
+    "num_antibiotics": "Int8",
+    "has_antibiotic": "Int8",
+    "drug_groups": "category",
+}
+
+# Columns read from the raw extract (everything downstream steps touch)
+USECOLS = list(DTYPES) + ["OPDID", "DateTimeOfVisit", "Complaint", "drug_names"]
+
+# Rows per chunk when streaming the raw extract
+CSV_CHUNKSIZE = 200_000
 
 # ============================================================
 # ANALYSIS PARAMETERS
@@ -0,0 +1,36 @@
+"""
+Parquet/pickle caches for intermediate data read by several steps.
+"""
+import os
+import pickle
+import pandas as pd
+
+
+def _is_fresh(cache_path, source_path):
+    """True if cache_path exists and is newer than source_path."""
+    return (os.path.exists(cache_path)
+            and os.path.getmtime(cache_path) > os.path.getmtime(source_path))
+
+
+def load_or_cache(csv_path):
+    """Read a CSV through a Parquet copy written alongside it on first use.
+
+    The copy is rebuilt whenever the CSV is newer than it.
+    """
+    pq_path = os.path.splitext(csv_path)[0] + ".parquet"
+    if _is_fresh(pq_path, csv_path):
+        return pd.read_parquet(pq_path)
+    df = pd.read_csv(csv_path, low_memory=False)
+    df.to_parquet(pq_path, engine="pyarrow", compression="zstd", index=False)
+    return df
+
+
+def cached_result(cache_path, source_path, build):
+    """Return build() pickled at cache_path, rebuilding if source_path is newer."""
+    if _is_fresh(cache_path, source_path):
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    result = build()
+    with open(cache_path, "wb") as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return result
@@ -0,0 +1,20 @@
+"""
+Shared plotting helpers for the pipeline steps.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import matplotlib.pyplot as plt
+
+# Threads used to encode PNGs (Agg releases the GIL while writing)
+SAVE_WORKERS = 4
+
+
+def save_figures(figs, dpi=150):
+    """Save (fig, path) pairs on a thread pool, then close the figures.
+
+    Figures must be fully built on the main thread first; only the
+    savefig calls run concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=SAVE_WORKERS) as ex:
+        list(ex.map(lambda fp: fp[0].savefig(fp[1], dpi=dpi), figs))
+    for fig, _ in figs:
+        plt.close(fig)
@@ -3,33 +3,66 @@ Step 1: Data Preparation & Exploratory Data Analysis
 =====================================================
 Data is already encounter-level from SQL extraction.
 This script:
-- Loads the CSV
+- Streams the CSV in typed chunks, cleaning age/weight outliers per chunk
 - Adds remaining derived variables (monotherapy, combination, polypharmacy)
-- Cleans age/weight outliers
 - Prints EDA statistics
-- Creates visualizations
-- Saves encounter_level_clean.csv
+- Creates the EDA figure panel
+- Saves encounter_level_clean.parquet
 """
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-import seaborn as sns
+from pandas.api.types import union_categoricals
 from config import (
     PATH_TO_DATA, ENCOUNTER_CLEAN_PATH, FIGURES_DIR,
     AGE_STRATA, MIN_AGE_MONTHS, MAX_AGE_MONTHS,
-    MIN_WEIGHT_KG, MAX_WEIGHT_KG, POLYPHARMACY_THRESHOLD
+    MIN_WEIGHT_KG, MAX_WEIGHT_KG, POLYPHARMACY_THRESHOLD,
+    DTYPES, USECOLS, CSV_CHUNKSIZE,
 )
 
 plt.style.use("seaborn-v0_8-whitegrid")
 
 
 def load_data(path):
-    """Load the encounter-level CSV."""
+    """Stream the encounter-level CSV in typed chunks, cleaning each chunk."""
     print("=" * 60)
     print("STEP 1: DATA PREPARATION & EXPLORATORY ANALYSIS")
     print("=" * 60)
 
-    df = pd.read_csv(path, low_memory=False)
+    print("\n--- Loading and cleaning data ---")
+    reader = pd.read_csv(
+        path,
+        usecols=lambda c: c in USECOLS,
+        dtype=DTYPES,
+        chunksize=CSV_CHUNKSIZE,
+    )
+    chunks = []
+    n_read = n_age_removed = n_invalid_wt = 0
+    for chunk in reader:
+        n_read += len(chunk)
+        chunk, n_age, n_wt = clean_data(chunk)
+        n_age_removed += n_age
+        n_invalid_wt += n_wt
+        chunks.append(chunk)
+
+    df = pd.concat(chunks, ignore_index=True)
+    # Chunks carry their own category sets; unify so columns stay categorical
+    for col in chunks[0].select_dtypes("category").columns:
+        df[col] = union_categoricals([c[col] for c in chunks])
+    del chunks
+
+    # Nullable ints let missing values through read_csv; hand plain numpy
+    # columns downstream (float32 where values are still missing)
+    for col in df.select_dtypes(["Int8", "Int16"]).columns:
+        dtype = np.float32 if df[col].isna().any() else df[col].dtype.numpy_dtype
+        df[col] = df[col].to_numpy(dtype=dtype, na_value=np.nan)
+
+    # Standardize drug_groups text (stripping can merge categories, so
+    # rebuild the categorical from the stripped strings)
+    if "drug_groups" in df.columns:
+        df["drug_groups"] = df["drug_groups"].astype(str).str.strip().astype("category")
 
     # Normalize column names for pseudonymised data
     rename_map = {
@@ -38,6 +71,11 @@ def load_data(path):
     }
     df.rename(columns={k: v for k, v in rename_map.items() if k in df.columns}, inplace=True)
 
+    print(f"  Removed {n_age_removed} encounters with invalid age")
+    print(f"  Set {n_invalid_wt} invalid weight values to NaN")
+    print(f"  Weight missing/NaN: {df['PatientWeight'].isna().sum()} encounters")
+    print(f"  Final dataset: {len(df)} encounters (removed {n_read - len(df)})")
+
     print(f"\nLoaded: {df.shape[0]} encounters, {df.shape[1]} columns")
     print(f"Columns: {list(df.columns)}")
     print(f"\nFirst 3 rows:")
@@ -50,11 +88,13 @@ def add_derived_variables(df):
     """Add antibiotic_monotherapy, antibiotic_combination, polypharmacy_flag."""
     print("\n--- Adding derived variables ---")
 
-    df["antibiotic_monotherapy"] = (df["num_antibiotics"] == 1).astype(int)
-    df["antibiotic_combination"] = (df["num_antibiotics"] >= 2).astype(int)
-    df["polypharmacy_flag"] = (
-        df["num_distinct_drugs"] >= POLYPHARMACY_THRESHOLD
-    ).astype(int)
+    # Compare on the raw arrays and reinterpret the bool results as uint8
+    # (no extra int64 copies)
+    n_ab = df["num_antibiotics"].to_numpy()
+    n_drugs = df["num_distinct_drugs"].to_numpy()
+    df["antibiotic_monotherapy"] = (n_ab == 1).view(np.uint8)
+    df["antibiotic_combination"] = (n_ab >= 2).view(np.uint8)
+    df["polypharmacy_flag"] = (n_drugs >= POLYPHARMACY_THRESHOLD).view(np.uint8)
 
     print(f"  antibiotic_monotherapy: {df['antibiotic_monotherapy'].sum()} encounters")
     print(f"  antibiotic_combination: {df['antibiotic_combination'].sum()} encounters")
@@ -63,102 +103,124 @@ def add_derived_variables(df):
 
 
 def clean_data(df):
-    """Apply data cleaning rules for age and weight."""
-    print("\n--- Cleaning data ---")
-    n_before = len(df)
+    """Apply data cleaning rules for age and weight to one chunk.
 
-    # Parse DateTimeOfVisit
+    Returns the cleaned chunk, the number of rows dropped for invalid age
+    and the number of weights set to NaN.
+    """
     df["DateTimeOfVisit"] = pd.to_datetime(df["DateTimeOfVisit"], errors="coerce")
 
-    # Age cleaning
-    mask_age = (df["age_months"] >= MIN_AGE_MONTHS) & (df["age_months"] <= MAX_AGE_MONTHS)
-    n_age_removed = (~mask_age).sum()
-    df = df[mask_age].copy()
-    print(f"  Removed {n_age_removed} encounters with invalid age")
+    # Build both masks from the raw arrays so each value is touched once;
+    # missing ages become NaN and fail the range check
+    age = df["age_months"].to_numpy(dtype=np.float32, na_value=np.nan)
+    weight = df["PatientWeight"].to_numpy()
+    keep = (age >= MIN_AGE_MONTHS) & (age <= MAX_AGE_MONTHS)
+    bad_weight = ((weight < MIN_WEIGHT_KG) | (weight > MAX_WEIGHT_KG))[keep]
+    n_age_removed = int(len(keep) - keep.sum())
+    n_invalid_wt = int(bad_weight.sum())
 
-    # Weight cleaning: set invalid to NaN, keep missing as NaN
-    invalid_weight = (
-        (df["PatientWeight"] < MIN_WEIGHT_KG) | (df["PatientWeight"] > MAX_WEIGHT_KG)
+    # Drop invalid ages; set invalid weights to NaN, keep missing as NaN
+    df = df.take(keep.nonzero()[0])
+    df.loc[bad_weight, "PatientWeight"] = np.nan
+
+    return df, n_age_removed, n_invalid_wt
+
+
+def age_stratum_summary(df):
+    """Encounter count and antibiotic rate per age stratum, in AGE_STRATA order."""
+    return df.groupby("age_stratum", observed=True).agg(
+        n=("OPDID", "count"),
+        ab_rate=("has_antibiotic", "mean"),
     )
-    n_invalid_wt = invalid_weight.sum()
-    df.loc[invalid_weight, "PatientWeight"] = np.nan
-    print(f"  Set {n_invalid_wt} invalid weight values to NaN")
-    print(f"  Weight missing/NaN: {df['PatientWeight'].isna().sum()} encounters")
 
-    # Standardize drug_groups text
-    if "drug_groups" in df.columns:
-        df["drug_groups"] = df["drug_groups"].astype(str).str.strip()
 
-    print(f"  Final dataset: {len(df)} encounters (removed {n_before - len(df)})")
+def downcast(df):
+    """Shrink numeric columns to the smallest dtype that holds their values."""
+    for col in df.select_dtypes("int64").columns:
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+    for col in df.select_dtypes("float64").columns:
+        df[col] = pd.to_numeric(df[col], downcast="float")
+    for col in ["has_antibiotic", "antibiotic_monotherapy",
+                "antibiotic_combination", "polypharmacy_flag"]:
+        # Flags with missing values stay float so NaN survives
+        df[col] = pd.to_numeric(df[col], downcast="unsigned")
     return df
 
 
-def print_eda(df):
+def print_eda(df, by_age):
     """Print exploratory statistics."""
     print("\n" + "=" * 60)
     print("EXPLORATORY DATA ANALYSIS")
     print("=" * 60)
 
+    # One fused reduction over all the columns the summary needs
+    stats = df.agg({
+        "has_antibiotic": ["sum", "mean"],
+        "antibiotic_monotherapy": ["sum"],
+        "antibiotic_combination": ["sum"],
+        "polypharmacy_flag": ["mean"],
+        "num_distinct_drugs": ["count", "mean", "std", "min", "max"],
+        "patient_id": ["nunique"],
+        "prescriber_id": ["nunique"],
+        "DateTimeOfVisit": ["min", "max"],
+    })
+
     total = len(df)
-    ab_n = df["has_antibiotic"].sum()
-    ab_rate = ab_n / total * 100
+    ab_n = int(stats.at["sum", "has_antibiotic"])
+    mono_n = int(stats.at["sum", "antibiotic_monotherapy"])
+    combo_n = int(stats.at["sum", "antibiotic_combination"])
+    ab_rate = stats.at["mean", "has_antibiotic"] * 100
 
     print(f"\nTotal encounters:          {total}")
-    print(f"Unique patients:           {df['patient_id'].nunique()}")
-    print(f"Unique prescribers:        {df['prescriber_id'].nunique()}")
-    print(f"Date range:                {df['DateTimeOfVisit'].min()} to {df['DateTimeOfVisit'].max()}")
+    print(f"Unique patients:           {int(stats.at['nunique', 'patient_id'])}")
+    print(f"Unique prescribers:        {int(stats.at['nunique', 'prescriber_id'])}")
+    print(f"Date range:                {stats.at['min', 'DateTimeOfVisit']} to {stats.at['max', 'DateTimeOfVisit']}")
     print(f"\nAntibiotic rate:           {ab_rate:.1f}% ({ab_n}/{total})")
-    print(f"Monotherapy rate (of AB):  {df['antibiotic_monotherapy'].sum()}/{ab_n} = "
-          f"{df['antibiotic_monotherapy'].sum() / ab_n * 100:.1f}%" if ab_n > 0 else "N/A")
-    print(f"Combination rate (of AB):  {df['antibiotic_combination'].sum()}/{ab_n} = "
-          f"{df['antibiotic_combination'].sum() / ab_n * 100:.1f}%" if ab_n > 0 else "N/A")
-    print(f"Polypharmacy rate:         {df['polypharmacy_flag'].mean() * 100:.1f}%")
-    print(f"Mean drugs/encounter:      {df['num_distinct_drugs'].mean():.2f}")
+    print(f"Monotherapy rate (of AB):  {mono_n}/{ab_n} = "
+          f"{mono_n / ab_n * 100:.1f}%" if ab_n > 0 else "N/A")
+    print(f"Combination rate (of AB):  {combo_n}/{ab_n} = "
+          f"{combo_n / ab_n * 100:.1f}%" if ab_n > 0 else "N/A")
+    print(f"Polypharmacy rate:         {stats.at['mean', 'polypharmacy_flag'] * 100:.1f}%")
+    print(f"Mean drugs/encounter:      {stats.at['mean', 'num_distinct_drugs']:.2f}")
 
     print("\n--- Antibiotic rate by age stratum ---")
-    age_order = [s[2] for s in AGE_STRATA]
-    age_ab = df.groupby("age_stratum").agg(
-        n=("OPDID", "count"),
-        ab_rate=("has_antibiotic", "mean"),
-    ).reindex(age_order).dropna()
+    age_ab = by_age.copy()
     age_ab["ab_rate_pct"] = (age_ab["ab_rate"] * 100).round(1)
     print(age_ab[["n", "ab_rate_pct"]].to_string())
 
     print("\n--- Distribution of num_distinct_drugs ---")
-    print(df["num_distinct_drugs"].describe().to_string())
+    print(stats["num_distinct_drugs"]
+          .reindex(["count", "mean", "std", "min", "max"]).to_string())
 
 
-def create_visualizations(df):
-    """Create and save EDA charts."""
+def create_visualizations(df, by_age):
+    """Create and save the EDA charts as one multi-panel figure."""
+    import seaborn as sns
+
     print("\n--- Creating visualizations ---")
 
     age_order = [s[2] for s in AGE_STRATA]
+    fig, axes = plt.subplots(2, 3, figsize=(18, 10))
+    axes = axes.flat
 
     # 1. Encounters by age group
-    fig, ax = plt.subplots(figsize=(10, 6))
-    counts = df["age_stratum"].value_counts().reindex(age_order).dropna()
-    counts.plot(kind="bar", ax=ax, color="steelblue", edgecolor="black")
+    ax = axes[0]
+    by_age["n"].plot(kind="bar", ax=ax, color="steelblue", edgecolor="black")
     ax.set_title("Number of Encounters by Age Group", fontsize=14)
     ax.set_xlabel("Age Stratum")
     ax.set_ylabel("Count")
-    plt.xticks(rotation=45, ha="right")
-    plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/01_encounters_by_age.png", dpi=150)
-    plt.close()
+    plt.setp(ax.get_xticklabels(), rotation=45, ha="right")
 
     # 2. Antibiotic pie chart
-    fig, ax = plt.subplots(figsize=(8, 8))
+    ax = axes[1]
     ab_counts = df["has_antibiotic"].value_counts().sort_index()
     ax.pie(ab_counts, labels=["No Antibiotic", "Has Antibiotic"],
            colors=["#66b3ff", "#ff6666"], autopct="%1.1f%%",
            startangle=90, textprops={"fontsize": 12})
     ax.set_title("Antibiotic vs Non-Antibiotic Encounters", fontsize=14)
-    plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/02_antibiotic_pie.png", dpi=150)
-    plt.close()
 
     # 3. Drugs per encounter histogram
-    fig, ax = plt.subplots(figsize=(10, 6))
+    ax = axes[2]
     max_drugs = int(df["num_distinct_drugs"].max())
     df["num_distinct_drugs"].plot(
         kind="hist", bins=range(1, max_drugs + 2),
@@ -167,12 +229,9 @@ def create_visualizations(df):
     ax.set_title("Distribution of Drugs per Encounter", fontsize=14)
     ax.set_xlabel("Number of Distinct Drugs")
     ax.set_ylabel("Count")
-    plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/03_drugs_histogram.png", dpi=150)
-    plt.close()
 
     # 4. Antibiotics by age stratum (box plot)
-    fig, ax = plt.subplots(figsize=(12, 6))
+    ax = axes[3]
     ab_data = df[df["has_antibiotic"] == 1]
     if len(ab_data) > 0:
         present = [a for a in age_order if a in ab_data["age_stratum"].values]
@@ -181,34 +240,42 @@ def create_visualizations(df):
     ax.set_title("Antibiotics per Encounter by Age (AB encounters only)", fontsize=14)
     ax.set_xlabel("Age Stratum")
     ax.set_ylabel("Number of Antibiotics")
-    plt.xticks(rotation=45, ha="right")
-    plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/04_antibiotics_by_age_box.png", dpi=150)
-    plt.close()
+    plt.setp(ax.get_xticklabels(), rotation=45, ha="right")
 
     # 5. Antibiotic rate by age stratum (bar)
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ab_by_age = df.groupby("age_stratum")["has_antibiotic"].mean().reindex(age_order).dropna() * 100
-    ab_by_age.plot(kind="bar", ax=ax, color="salmon", edgecolor="black")
+    ax = axes[4]
+    (by_age["ab_rate"] * 100).plot(kind="bar", ax=ax, color="salmon", edgecolor="black")
     ax.set_title("Antibiotic Prescribing Rate by Age Group", fontsize=14)
     ax.set_xlabel("Age Stratum")
     ax.set_ylabel("Antibiotic Rate (%)")
-    plt.xticks(rotation=45, ha="right")
-    plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/05_ab_rate_by_age.png", dpi=150)
-    plt.close()
+    plt.setp(ax.get_xticklabels(), rotation=45, ha="right")
+
+    axes[5].axis("off")
+
+    # Fixed spacing instead of a tight_layout solve
+    fig.subplots_adjust(hspace=0.6, wspace=0.3, bottom=0.15)
+    fig.savefig(f"{FIGURES_DIR}/01_eda_panel.png", dpi=150)
+    plt.close(fig)
 
-    print(f"  Saved 5 figures to {FIGURES_DIR}/")
+    print(f"  Saved EDA panel to {FIGURES_DIR}/01_eda_panel.png")
 
 
 def run():
     """Execute Step 1."""
     df = load_data(PATH_TO_DATA)
     df = add_derived_variables(df)
-    df = clean_data(df)
-    print_eda(df)
-    create_visualizations(df)
-    df.to_csv(ENCOUNTER_CLEAN_PATH, index=False)
+    df = downcast(df)
+
+    # Ordered categorical: groupbys use the integer codes and come out in
+    # AGE_STRATA order without a reindex
+    df["age_stratum"] = pd.Categorical(
+        df["age_stratum"], categories=[s[2] for s in AGE_STRATA], ordered=True
+    )
+    by_age = age_stratum_summary(df)
+
+    print_eda(df, by_age)
+    create_visualizations(df, by_age)
+    df.to_parquet(ENCOUNTER_CLEAN_PATH, engine="pyarrow", compression="zstd", index=False)
     print(f"\nSaved: {ENCOUNTER_CLEAN_PATH}")
     return df
 
@@ -4,12 +4,12 @@ Step 2: Prescriber Behaviour Analysis
 - Calculate prescriber-level metrics
 - Merge back to encounter level
 - Visualize prescriber behaviour
-- Save encounter_level_with_prescriber.csv
+- Save encounter_level_with_prescriber.parquet
 """
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-import seaborn as sns
+from plotting import save_figures
 from config import ENCOUNTER_CLEAN_PATH, ENCOUNTER_PRESCRIBER_PATH, FIGURES_DIR
 
 plt.style.use("seaborn-v0_8-whitegrid")
@@ -20,7 +20,7 @@ def run():
     print("STEP 2: PRESCRIBER BEHAVIOUR ANALYSIS")
     print("=" * 60)
 
-    df = pd.read_csv(ENCOUNTER_CLEAN_PATH, low_memory=False)
+    df = pd.read_parquet(ENCOUNTER_CLEAN_PATH)
     print(f"\nLoaded: {len(df)} encounters")
     print(f"Unique prescribers: {df['prescriber_id'].nunique()}")
 
@@ -28,22 +28,24 @@ def run():
     # Calculate prescriber-level metrics
     # ------------------------------------------------------------------
     print("\n--- Computing prescriber metrics ---")
-    prescriber = df.groupby("prescriber_id").agg(
+    prescriber = df.groupby("prescriber_id", observed=True).agg(
         prescriber_total_encounters=("OPDID", "count"),
         prescriber_ab_encounters=("has_antibiotic", "sum"),
         prescriber_sum_antibiotics=("num_antibiotics", "sum"),
         prescriber_polypharmacy_encounters=("polypharmacy_flag", "sum"),
     ).reset_index()
 
-    prescriber["prescriber_antibiotic_rate"] = (
-        prescriber["prescriber_ab_encounters"] / prescriber["prescriber_total_encounters"]
-    ).round(4)
-    prescriber["prescriber_mean_num_antibiotics"] = (
-        prescriber["prescriber_sum_antibiotics"] / prescriber["prescriber_total_encounters"]
-    ).round(4)
-    prescriber["prescriber_polypharmacy_rate"] = (
-        prescriber["prescriber_polypharmacy_encounters"] / prescriber["prescriber_total_encounters"]
-    ).round(4)
+    # Ratios on the raw arrays in float32 (these columns are copied onto
+    # every encounter row by the join below)
+    total = prescriber["prescriber_total_encounters"].to_numpy(dtype=np.float32)
+    for rate_col, count_col in [
+        ("prescriber_antibiotic_rate", "prescriber_ab_encounters"),
+        ("prescriber_mean_num_antibiotics", "prescriber_sum_antibiotics"),
+        ("prescriber_polypharmacy_rate", "prescriber_polypharmacy_encounters"),
+    ]:
+        prescriber[rate_col] = np.round(
+            prescriber[count_col].to_numpy(dtype=np.float32) / total, 4
+        )
 
     print(f"\nPrescriber summary statistics:")
     print(prescriber[[
@@ -66,18 +68,19 @@ def run():
     # Merge prescriber metrics to encounter level
     # ------------------------------------------------------------------
     merge_cols = [
-        "prescriber_id",
         "prescriber_antibiotic_rate",
         "prescriber_mean_num_antibiotics",
         "prescriber_polypharmacy_rate",
     ]
-    df = df.merge(prescriber[merge_cols], on="prescriber_id", how="left")
+    df = df.join(prescriber.set_index("prescriber_id")[merge_cols], on="prescriber_id")
     print(f"\nMerged prescriber metrics. Dataset: {len(df)} rows, {df.shape[1]} cols")
 
     # ------------------------------------------------------------------
     # Visualizations
     # ------------------------------------------------------------------
     print("\n--- Creating prescriber visualizations ---")
+    import seaborn as sns
+    figs = []
 
     # 1. Distribution of prescriber antibiotic rates
     fig, ax = plt.subplots(figsize=(10, 6))
@@ -88,8 +91,7 @@ def run():
     ax.set_xlabel("Antibiotic Prescribing Rate")
     ax.set_ylabel("Number of Prescribers")
     plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/06_prescriber_ab_rate_dist.png", dpi=150)
-    plt.close()
+    figs.append((fig, f"{FIGURES_DIR}/06_prescriber_ab_rate_dist.png"))
 
     # 2. Prescriber volume vs antibiotic rate scatter
     fig, ax = plt.subplots(figsize=(10, 6))
@@ -102,8 +104,7 @@ def run():
     ax.set_xlabel("Total Encounters")
     ax.set_ylabel("Antibiotic Rate")
     plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/07_prescriber_volume_vs_ab.png", dpi=150)
-    plt.close()
+    figs.append((fig, f"{FIGURES_DIR}/07_prescriber_volume_vs_ab.png"))
 
     # 3. Box plot of prescriber rates
     fig, axes = plt.subplots(1, 3, figsize=(15, 5))
@@ -120,15 +121,15 @@ def run():
         ax.set_title(title, fontsize=12)
     plt.suptitle("Prescriber Behaviour Distributions", fontsize=14)
     plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/08_prescriber_behaviour_box.png", dpi=150)
-    plt.close()
+    figs.append((fig, f"{FIGURES_DIR}/08_prescriber_behaviour_box.png"))
 
+    save_figures(figs)
     print(f"  Saved prescriber figures to {FIGURES_DIR}/")
 
     # ------------------------------------------------------------------
     # Save
     # ------------------------------------------------------------------
-    df.to_csv(ENCOUNTER_PRESCRIBER_PATH, index=False)
+    df.to_parquet(ENCOUNTER_PRESCRIBER_PATH, engine="pyarrow", compression="zstd", index=False)
     print(f"\nSaved: {ENCOUNTER_PRESCRIBER_PATH}")
     return df
 
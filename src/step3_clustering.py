@@ -2,25 +2,24 @@
 Step 3: Clustering Analysis
 =============================
 - Prepare feature matrix (numerical scaled, binary, categorical one-hot)
-- Compute Gower distance matrix
-- Run k-medoids for k = 3..8
+- Compute Gower distance matrix (blocked, float32, cached on disk)
+- Run k-medoids for k = 3..8 (in parallel)
 - Evaluate silhouette scores
 - User picks optimal k, then generate cluster profiles
 - PCA plot, heatmap, comparisons
 - Save encounter_level_clustered.csv
 """
+import os
+import glob
+import hashlib
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-import seaborn as sns
 from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from sklearn.metrics import silhouette_score
-import gower
-import kmedoids
+from plotting import save_figures
 from config import (
     ENCOUNTER_PRESCRIBER_PATH, ENCOUNTER_CLUSTERED_PATH,
-    FIGURES_DIR, K_RANGE, AGE_STRATA
+    FIGURES_DIR, DATA_DIR, K_RANGE, AGE_STRATA
 )
 
 plt.style.use("seaborn-v0_8-whitegrid")
@@ -35,6 +34,12 @@ BINARY_FEATURES = [
 ]
 CATEGORICAL_FEATURES = ["age_stratum", "Gender", "VisitType"]
 
+# Rows of the Gower matrix computed per block (bounds temporary memory)
+GOWER_BLOCK_ROWS = 512
+
+# Max encounters drawn in the PCA scatter
+PCA_MAX_POINTS = 20_000
+
 
 def prepare_features(df):
     """Build the feature matrix for clustering."""
@@ -43,19 +48,19 @@ def prepare_features(df):
     # Handle missing weight: fill with median
     df["PatientWeight"] = df["PatientWeight"].fillna(df["PatientWeight"].median())
 
-    # Scale numerical features
+    # Scale numerical features (float32: the Gower kernel runs in float32)
     scaler = StandardScaler()
     num_scaled = pd.DataFrame(
-        scaler.fit_transform(df[NUMERICAL_FEATURES]),
+        scaler.fit_transform(df[NUMERICAL_FEATURES]).astype(np.float32),
         columns=[f"{c}_scaled" for c in NUMERICAL_FEATURES],
         index=df.index,
     )
 
-    # Binary features (already 0/1)
+    # Binary features (already 0/1; uint8 from step 1, float if any are missing)
     bin_df = df[BINARY_FEATURES].copy()
 
     # One-hot encode categorical features
-    cat_df = pd.get_dummies(df[CATEGORICAL_FEATURES], drop_first=False).astype(int)
+    cat_df = pd.get_dummies(df[CATEGORICAL_FEATURES], drop_first=False, dtype=np.uint8)
 
     # Combine
     feature_matrix = pd.concat([num_scaled, bin_df, cat_df], axis=1)
@@ -67,21 +72,105 @@ def prepare_features(df):
     return feature_matrix
 
 
+def gower_distance(feature_matrix, cat_mask, block_rows=GOWER_BLOCK_ROWS):
+    """Compute the Gower distance matrix in row blocks, as float32.
+
+    Numerical columns contribute |a - b| / range and categorical columns
+    a != b; the distance is the mean over all columns. Only the upper
+    triangle is computed (one block of rows at a time) and mirrored, so
+    temporaries stay O(block_rows * n) instead of O(n^2).
+    """
+    cat_mask = np.asarray(cat_mask, dtype=bool)
+    values = np.asarray(feature_matrix, dtype=np.float32)
+    n, n_features = values.shape
+
+    # Column-major copies so each feature is one contiguous array
+    num = np.ascontiguousarray(values[:, ~cat_mask].T)
+    cat = np.ascontiguousarray(values[:, cat_mask].T)
+    ranges = num.max(axis=1) - num.min(axis=1)
+    inv_range = np.divide(1, ranges, out=np.zeros_like(ranges), where=ranges != 0)
+
+    out = np.empty((n, n), dtype=np.float32)
+    for i0 in range(0, n, block_rows):
+        i1 = min(i0 + block_rows, n)
+        block = np.zeros((i1 - i0, n - i0), dtype=np.float32)
+        diff = np.empty_like(block)
+        mismatch = np.empty(block.shape, dtype=bool)
+        for col, scale in zip(num, inv_range):
+            np.subtract(col[i0:i1, None], col[None, i0:], out=diff)
+            np.abs(diff, out=diff)
+            diff *= scale
+            block += diff
+        for col in cat:
+            np.not_equal(col[i0:i1, None], col[None, i0:], out=mismatch)
+            block += mismatch
+        block /= n_features
+        out[i0:i1, i0:] = block
+        out[i0:, i0:i1] = block.T
+    return out
+
+
+def _fit_one_k(gower_path, k):
+    """Fit k-medoids for one k on the cached Gower matrix."""
+    import kmedoids
+    from sklearn.metrics import silhouette_score
+
+    gower_dist = np.load(gower_path, mmap_mode="r")
+    km_result = kmedoids.fasterpam(gower_dist, k, random_state=42, max_iter=300)
+    sil = silhouette_score(gower_dist, km_result.labels, metric="precomputed")
+    return k, km_result, sil
+
+
+def cached_gower_distance(feature_matrix):
+    """Gower matrix for feature_matrix, cached on disk by a feature hash.
+
+    Returns the (read-only, memory-mapped when cached) matrix and the
+    path of its .npy cache file.
+    """
+    # Mark which columns are categorical (binary + one-hot)
+    cat_mask = np.array([not col.endswith("_scaled") for col in feature_matrix.columns])
+
+    # One float32 array serves both the hash and the kernel
+    values = np.ascontiguousarray(feature_matrix.to_numpy(dtype=np.float32))
+
+    # Reuse a cached matrix when the features are unchanged
+    h = hashlib.blake2b(digest_size=8)
+    h.update("|".join(feature_matrix.columns).encode())
+    h.update(values.tobytes())
+    cache_path = os.path.join(DATA_DIR, f"gower_{h.hexdigest()}.npy")
+    if os.path.exists(cache_path):
+        gower_dist = np.load(cache_path, mmap_mode="r")
+        print(f"  Loaded cached matrix: {cache_path}")
+    else:
+        gower_dist = gower_distance(values, cat_mask)
+        np.save(cache_path, gower_dist)
+        print(f"  Cached matrix: {cache_path}")
+        # Matrices for earlier feature sets are never read again
+        for stale in glob.glob(os.path.join(DATA_DIR, "gower_*.npy")):
+            if stale != cache_path:
+                os.remove(stale)
+    return gower_dist, cache_path
+
+
 def compute_gower_and_cluster(feature_matrix, k_range):
     """Compute Gower distance and run k-medoids for each k."""
+    from joblib import Parallel, delayed
+
     print("\n--- Computing Gower distance matrix ---")
-    # Mark which columns are categorical (binary + one-hot)
-    cat_mask = [not col.endswith("_scaled") for col in feature_matrix.columns]
-    gower_dist = gower.gower_matrix(feature_matrix, cat_features=cat_mask)
+    gower_dist, cache_path = cached_gower_distance(feature_matrix)
     print(f"  Gower distance matrix: {gower_dist.shape}")
 
-    results = {}
+    # Each k is independent; workers memory-map the cached matrix rather
+    # than receiving a pickled copy
     print(f"\n--- Running k-medoids for k = {min(k_range)}..{max(k_range)} ---")
-    for k in k_range:
-        km_result = kmedoids.fasterpam(gower_dist, k, random_state=42, max_iter=300)
-        labels = km_result.labels
-        sil = silhouette_score(gower_dist, labels, metric="precomputed")
-        results[k] = {"labels": labels, "silhouette": sil, "km_result": km_result}
+    n_jobs = min(len(k_range), os.cpu_count() or 1)
+    outputs = Parallel(n_jobs=n_jobs, backend="loky")(
+        delayed(_fit_one_k)(cache_path, k) for k in k_range
+    )
+
+    results = {}
+    for k, km_result, sil in outputs:
+        results[k] = {"labels": km_result.labels, "silhouette": sil, "km_result": km_result}
         print(f"  k={k}: silhouette = {sil:.4f}")
 
     return gower_dist, results
@@ -153,21 +242,27 @@ def cluster_profiles(df):
 
 def create_cluster_visualizations(df, feature_matrix, profiles):
     """PCA plot, heatmap, bar comparisons."""
+    import seaborn as sns
+    from sklearn.decomposition import PCA
+
     print("\n--- Creating cluster visualizations ---")
+    figs = []
 
-    # 1. PCA 2D plot
+    # 1. PCA 2D plot (fit and drawn on a random subsample)
+    rng = np.random.default_rng(42)
+    n = len(feature_matrix)
+    idx = rng.choice(n, size=min(PCA_MAX_POINTS, n), replace=False)
     pca = PCA(n_components=2, random_state=42)
-    coords = pca.fit_transform(feature_matrix)
+    coords = pca.fit_transform(feature_matrix.iloc[idx].to_numpy(dtype=np.float32))
     fig, ax = plt.subplots(figsize=(10, 8))
-    scatter = ax.scatter(coords[:, 0], coords[:, 1], c=df["cluster"],
+    scatter = ax.scatter(coords[:, 0], coords[:, 1], c=df["cluster"].to_numpy()[idx],
                          cmap="tab10", alpha=0.5, s=10)
     ax.set_title("PCA Projection of Clusters", fontsize=14)
     ax.set_xlabel(f"PC1 ({pca.explained_variance_ratio_[0]*100:.1f}%)")
     ax.set_ylabel(f"PC2 ({pca.explained_variance_ratio_[1]*100:.1f}%)")
     plt.colorbar(scatter, label="Cluster")
     plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/10_pca_clusters.png", dpi=150)
-    plt.close()
+    figs.append((fig, f"{FIGURES_DIR}/10_pca_clusters.png"))
 
     # 2. Heatmap of cluster characteristics
     fig, ax = plt.subplots(figsize=(12, 6))
@@ -176,8 +271,7 @@ def create_cluster_visualizations(df, feature_matrix, profiles):
     ax.set_xlabel("Cluster")
     ax.set_ylabel("Feature")
     plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/11_cluster_heatmap.png", dpi=150)
-    plt.close()
+    figs.append((fig, f"{FIGURES_DIR}/11_cluster_heatmap.png"))
 
     # 3. Bar chart comparing key metrics across clusters
     key_metrics = ["has_antibiotic", "polypharmacy_flag", "antibiotic_combination"]
@@ -191,8 +285,7 @@ def create_cluster_visualizations(df, feature_matrix, profiles):
     ax.legend(title="Metric")
     plt.xticks(rotation=0)
     plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/12_cluster_comparison_bars.png", dpi=150)
-    plt.close()
+    figs.append((fig, f"{FIGURES_DIR}/12_cluster_comparison_bars.png"))
 
     # 4. Cluster size bar chart
     fig, ax = plt.subplots(figsize=(8, 5))
@@ -204,9 +297,9 @@ def create_cluster_visualizations(df, feature_matrix, profiles):
     ax.set_ylabel("Number of Encounters")
     plt.xticks(rotation=0)
     plt.tight_layout()
-    plt.savefig(f"{FIGURES_DIR}/13_cluster_sizes.png", dpi=150)
-    plt.close()
+    figs.append((fig, f"{FIGURES_DIR}/13_cluster_sizes.png"))
 
+    save_figures(figs)
     print(f"  Saved cluster figures to {FIGURES_DIR}/")
 
 
@@ -215,7 +308,7 @@ def run():
     print("STEP 3: CLUSTERING ANALYSIS")
     print("=" * 60)
 
-    df = pd.read_csv(ENCOUNTER_PRESCRIBER_PATH, low_memory=False)
+    df = pd.read_parquet(ENCOUNTER_PRESCRIBER_PATH)
     print(f"\nLoaded: {len(df)} encounters")
 
     # Prepare features
@@ -6,19 +6,93 @@ Step 4: Cluster Interpretation & Archetype Naming
 - Suggest archetype names
 - Generate Word report
 """
+from copy import deepcopy
 import pandas as pd
 import numpy as np
-from collections import Counter
 from docx import Document
 from docx.shared import Inches, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from data_cache import load_or_cache
 from config import ENCOUNTER_CLUSTERED_PATH, REPORTS_DIR, FIGURES_DIR, AGE_STRATA
 
+# String columns profiled per cluster; stored as category so value_counts,
+# mode and groupby work on integer codes
+CATEGORY_COLUMNS = ["Gender", "VisitType", "age_stratum", "Complaint", "drug_names"]
+
+
+def top_tokens(series, sep, n=10):
+    """Split delimited strings and return the n most common (token, count) pairs."""
+    tokens = series.dropna().astype(str).str.split(sep).explode().str.strip()
+    tokens = tokens[(tokens.str.len() > 0) & (tokens.str.lower() != "nan")]
+    # Partial selection of the top n instead of sorting every token count
+    return list(tokens.value_counts(sort=False).nlargest(n).items())
+
+
+def _category_counts(cluster_codes, cluster_ids, col):
+    """Cluster x category count table for a categorical column via one bincount."""
+    codes = col.cat.codes.to_numpy()
+    cats = col.cat.categories
+    valid = codes >= 0
+    flat = cluster_codes[valid] * len(cats) + codes[valid]
+    counts = np.bincount(flat, minlength=len(cluster_ids) * len(cats))
+    return pd.DataFrame(counts.reshape(len(cluster_ids), len(cats)),
+                        index=cluster_ids, columns=cats)
+
+
+def profile_clusters(df):
+    """Compute per-cluster aggregates for every cluster in one pass.
+
+    Returns a dict of frames/series indexed by cluster id, which
+    analyse_cluster reads from instead of re-filtering df per cluster.
+    """
+    g = df.groupby("cluster")
+    agg_spec = {
+        "n": ("cluster", "size"),
+        "mean_age_months": ("age_months", "mean"),
+        "mean_weight": ("PatientWeight", "mean"),
+        "ab_rate": ("has_antibiotic", "mean"),
+        "mono_rate": ("antibiotic_monotherapy", "mean"),
+        "combo_rate": ("antibiotic_combination", "mean"),
+        "polypharmacy_rate": ("polypharmacy_flag", "mean"),
+        "mean_drugs": ("num_distinct_drugs", "mean"),
+        "mean_antibiotics": ("num_antibiotics", "mean"),
+    }
+    if "prescriber_antibiotic_rate" in df.columns:
+        agg_spec["mean_prescriber_ab_rate"] = ("prescriber_antibiotic_rate", "mean")
+        agg_spec["std_prescriber_ab_rate"] = ("prescriber_antibiotic_rate", "std")
+
+    tokens = {
+        cid: (top_tokens(c["Complaint"], ","), top_tokens(c["drug_names"], "|"))
+        for cid, c in g[["Complaint", "drug_names"]]
+    }
+
+    # Category distributions straight from the codes; argmax breaks ties
+    # on the first category, as mode() does
+    cluster_codes, cluster_ids = pd.factorize(df["cluster"], sort=True)
+    age_counts = _category_counts(cluster_codes, cluster_ids, df["age_stratum"])
+
+    return {
+        "stats": g.agg(**agg_spec),
+        "dominant_age": pd.Series(age_counts.columns[age_counts.to_numpy().argmax(axis=1)],
+                                  index=cluster_ids),
+        "gender": _category_counts(cluster_codes, cluster_ids, df["Gender"]),
+        "visit_type": _category_counts(cluster_codes, cluster_ids, df["VisitType"]),
+        "tokens": tokens,
+    }
+
 
-def analyse_cluster(df, cluster_id):
-    """Analyse a single cluster and return a summary dict."""
-    c = df[df["cluster"] == cluster_id]
-    n = len(c)
+def _counts_dict(counts, n=None):
+    """Non-zero counts from one unstacked row, largest first."""
+    counts = counts[counts > 0].sort_values(ascending=False)
+    return (counts if n is None else counts.head(n)).to_dict()
+
+
+def analyse_cluster(df, cluster_id, profiles):
+    """Build the summary dict for one cluster from precomputed profiles."""
+    row = profiles["stats"].loc[cluster_id]
+    n = int(row["n"])
     total = len(df)
 
     summary = {
@@ -28,42 +102,27 @@ def analyse_cluster(df, cluster_id):
     }
 
     # Clinical profile
-    summary["mean_age_months"] = round(c["age_months"].mean(), 1)
-    summary["mean_weight"] = round(c["PatientWeight"].mean(), 1) if c["PatientWeight"].notna().any() else "N/A"
-    summary["dominant_age_group"] = c["age_stratum"].mode().iloc[0] if len(c) > 0 else "N/A"
-    summary["gender_dist"] = c["Gender"].value_counts().to_dict()
-    summary["visit_type_dist"] = c["VisitType"].value_counts().head(5).to_dict()
+    summary["mean_age_months"] = round(row["mean_age_months"], 1)
+    summary["mean_weight"] = round(row["mean_weight"], 1) if pd.notna(row["mean_weight"]) else "N/A"
+    summary["dominant_age_group"] = profiles["dominant_age"].loc[cluster_id]
+    summary["gender_dist"] = _counts_dict(profiles["gender"].loc[cluster_id])
+    summary["visit_type_dist"] = _counts_dict(profiles["visit_type"].loc[cluster_id], 5)
 
     # Prescribing pattern
-    summary["ab_rate"] = round(c["has_antibiotic"].mean() * 100, 1)
-    summary["mono_rate"] = round(c["antibiotic_monotherapy"].mean() * 100, 1)
-    summary["combo_rate"] = round(c["antibiotic_combination"].mean() * 100, 1)
-    summary["polypharmacy_rate"] = round(c["polypharmacy_flag"].mean() * 100, 1)
-    summary["mean_drugs"] = round(c["num_distinct_drugs"].mean(), 2)
-    summary["mean_antibiotics"] = round(c["num_antibiotics"].mean(), 2)
+    summary["ab_rate"] = round(row["ab_rate"] * 100, 1)
+    summary["mono_rate"] = round(row["mono_rate"] * 100, 1)
+    summary["combo_rate"] = round(row["combo_rate"] * 100, 1)
+    summary["polypharmacy_rate"] = round(row["polypharmacy_rate"] * 100, 1)
+    summary["mean_drugs"] = round(row["mean_drugs"], 2)
+    summary["mean_antibiotics"] = round(row["mean_antibiotics"], 2)
 
     # Prescriber characteristics
-    if "prescriber_antibiotic_rate" in c.columns:
-        summary["mean_prescriber_ab_rate"] = round(c["prescriber_antibiotic_rate"].mean() * 100, 1)
-        summary["std_prescriber_ab_rate"] = round(c["prescriber_antibiotic_rate"].std() * 100, 1)
-
-    # Top 10 complaints
-    complaints = []
-    for comp_str in c["Complaint"].dropna():
-        for comp in str(comp_str).split(","):
-            comp = comp.strip()
-            if comp and comp.lower() not in ("nan", ""):
-                complaints.append(comp)
-    summary["top_complaints"] = Counter(complaints).most_common(10)
-
-    # Top 10 drugs
-    drugs = []
-    for drug_str in c["drug_names"].dropna():
-        for d in str(drug_str).split("|"):
-            d = d.strip()
-            if d and d.lower() not in ("nan", ""):
-                drugs.append(d)
-    summary["top_drugs"] = Counter(drugs).most_common(10)
+    if "mean_prescriber_ab_rate" in row.index:
+        summary["mean_prescriber_ab_rate"] = round(row["mean_prescriber_ab_rate"] * 100, 1)
+        summary["std_prescriber_ab_rate"] = round(row["std_prescriber_ab_rate"] * 100, 1)
+
+    # Top 10 complaints and drugs
+    summary["top_complaints"], summary["top_drugs"] = profiles["tokens"][cluster_id]
 
     return summary
 
@@ -112,6 +171,32 @@ def suggest_archetype_name(summary):
     return " / ".join(parts)
 
 
+def _append_table_rows(table, rows):
+    """Append rows of cell strings to a python-docx table as raw <w:tr> XML.
+
+    Skips the per-cell .text setter; cell widths are copied from the
+    first (header) row.
+    """
+    tc_props = [tc.tcPr for tc in table.rows[0]._tr.tc_lst]
+    tbl = table._tbl
+    for values in rows:
+        tr = OxmlElement("w:tr")
+        for tc_pr, value in zip(tc_props, values):
+            tc = OxmlElement("w:tc")
+            if tc_pr is not None:
+                tc.append(deepcopy(tc_pr))
+            p = OxmlElement("w:p")
+            r = OxmlElement("w:r")
+            t = OxmlElement("w:t")
+            t.text = value
+            t.set(qn("xml:space"), "preserve")
+            r.append(t)
+            p.append(r)
+            tc.append(p)
+            tr.append(tc)
+        tbl.append(tr)
+
+
 def create_word_report(cluster_summaries, df):
     """Generate a professional Word document report."""
     doc = Document()
@@ -128,22 +213,19 @@ def create_word_report(cluster_summaries, df):
 
     # Executive summary table
     doc.add_heading("Executive Summary", level=1)
-    n_clusters = len(cluster_summaries)
-    table = doc.add_table(rows=n_clusters + 1, cols=7)
+    table = doc.add_table(rows=1, cols=7)
     table.style = "Light Shading Accent 1"
     headers = ["Cluster", "N (%)", "AB Rate%", "Mono%", "Combo%", "Polypharm%", "Archetype"]
     for i, h in enumerate(headers):
         table.rows[0].cells[i].text = h
 
-    for idx, s in enumerate(cluster_summaries):
-        row = table.rows[idx + 1]
-        row.cells[0].text = str(s["cluster"])
-        row.cells[1].text = f"{s['n']} ({s['pct_of_total']}%)"
-        row.cells[2].text = f"{s['ab_rate']}"
-        row.cells[3].text = f"{s['mono_rate']}"
-        row.cells[4].text = f"{s['combo_rate']}"
-        row.cells[5].text = f"{s['polypharmacy_rate']}"
-        row.cells[6].text = s.get("archetype_name", "")
+    rows = [
+        [str(s["cluster"]), f"{s['n']} ({s['pct_of_total']}%)", f"{s['ab_rate']}",
+         f"{s['mono_rate']}", f"{s['combo_rate']}", f"{s['polypharmacy_rate']}",
+         s.get("archetype_name", "")]
+        for s in cluster_summaries
+    ]
+    _append_table_rows(table, rows)
 
     doc.add_paragraph("")
 
@@ -214,15 +296,18 @@ def run():
     print("STEP 4: ARCHETYPE INTERPRETATION")
     print("=" * 60)
 
-    df = pd.read_csv(ENCOUNTER_CLUSTERED_PATH, low_memory=False)
+    df = load_or_cache(ENCOUNTER_CLUSTERED_PATH)
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype("category")
     print(f"\nLoaded: {len(df)} encounters with {df['cluster'].nunique()} clusters")
 
-    cluster_ids = sorted(df["cluster"].unique())
+    profiles = profile_clusters(df)
+    cluster_ids = profiles["stats"].index
     summaries = []
 
     for cid in cluster_ids:
         print(f"\n--- Cluster {cid} ---")
-        s = analyse_cluster(df, cid)
+        s = analyse_cluster(df, cid, profiles)
         s["archetype_name"] = suggest_archetype_name(s)
         print(f"  Suggested archetype: {s['archetype_name']}")
         print(f"  N={s['n']} ({s['pct_of_total']}%), AB rate={s['ab_rate']}%, "
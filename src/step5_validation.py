@@ -2,30 +2,106 @@
 Step 5: Validation Analysis
 =============================
 - Bootstrap resampling (20 iterations on manageable subsamples)
-- Cluster stability via ARI and silhouette
+- Cluster stability via ARI, silhouette and per-cluster co-assignment
 - Statistical tests comparing clusters
 - Validation summary report
 """
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-import seaborn as sns
 from sklearn.metrics import silhouette_score, adjusted_rand_score
 import kmedoids as km_lib
-import gower
 from scipy import stats
+from joblib import Parallel, delayed
+from data_cache import load_or_cache, cached_result
 from config import (
     ENCOUNTER_CLUSTERED_PATH, ENCOUNTER_PRESCRIBER_PATH,
-    FIGURES_DIR, REPORTS_DIR,
+    FEATURE_MATRIX_CACHE_PATH, FIGURES_DIR, REPORTS_DIR,
     BOOTSTRAP_ITERATIONS, BOOTSTRAP_SAMPLE_FRACTION
 )
-from step3_clustering import NUMERICAL_FEATURES, BINARY_FEATURES, CATEGORICAL_FEATURES, prepare_features
+from step3_clustering import (
+    NUMERICAL_FEATURES, BINARY_FEATURES, CATEGORICAL_FEATURES,
+    prepare_features, cached_gower_distance,
+)
 
 plt.style.use("seaborn-v0_8-whitegrid")
 
 # Max sample size per bootstrap iteration to keep memory manageable
 BOOTSTRAP_MAX_SAMPLE = 3000
 
+# Points used for each bootstrap iteration's silhouette estimate
+BOOTSTRAP_SILHOUETTE_SAMPLE = 500
+
+# Max encounters shown in the co-assignment heatmap
+STABILITY_HEATMAP_POINTS = 500
+
+
+def _stratified_sample(labels, max_points):
+    """Row indices drawn evenly per cluster, ordered by cluster label."""
+    if len(labels) <= max_points:
+        return np.argsort(labels, kind="stable")
+    clusters = np.unique(labels)
+    per_cluster = max_points // len(clusters)
+    picked = np.concatenate([
+        np.random.choice(members, size=min(per_cluster, len(members)), replace=False)
+        for members in (np.where(labels == c)[0] for c in clusters)
+    ])
+    return picked[np.argsort(labels[picked], kind="stable")]
+
+
+def _update_pair_counts(pair_same, pair_total, orig_subset, labels):
+    """Add one bootstrap run's within-cluster pair counts in place.
+
+    For each original cluster c in the sample, pair_total gains C(n_c, 2)
+    and pair_same gains the pairs that share a bootstrap cluster,
+    sum over b of C(n_cb, 2), read off the original x bootstrap crosstab.
+    """
+    ct = pd.crosstab(orig_subset, labels)
+    n_cb = ct.to_numpy(dtype=np.int64)
+    n_c = n_cb.sum(axis=1)
+    rows = ct.index.to_numpy()
+    pair_same[rows] += (n_cb * (n_cb - 1) // 2).sum(axis=1)
+    pair_total[rows] += n_c * (n_c - 1) // 2
+
+
+def _one_iter(i, idx, gower_path, best_k, orig_subset, picked):
+    """Cluster one bootstrap sample.
+
+    Returns (ARI, silhouette, labels, idx, picked_labels), where
+    picked_labels assigns the heatmap encounters to this run's nearest
+    medoid whether or not they were drawn into the sample.
+    """
+    gower_full = np.load(gower_path, mmap_mode="r")
+
+    # Gower distance on sample
+    gower_dist = np.ascontiguousarray(gower_full[np.ix_(idx, idx)])
+
+    # K-medoids
+    km_result = km_lib.fasterpam(gower_dist, best_k, random_state=i, max_iter=300)
+    boot_labels = np.asarray(km_result.labels)
+
+    # Silhouette score
+    sil = None
+    if len(set(boot_labels)) > 1:
+        sil = silhouette_score(
+            gower_dist, boot_labels, metric="precomputed",
+            sample_size=min(BOOTSTRAP_SILHOUETTE_SAMPLE, len(boot_labels)),
+            random_state=i,
+        )
+
+    # ARI with original labels
+    ari = adjusted_rand_score(orig_subset, boot_labels)
+
+    # Heatmap encounters go to the closest of this run's medoids
+    medoids = idx[np.asarray(km_result.medoids)]
+    picked_labels = np.argmin(gower_full[np.ix_(picked, medoids)], axis=1)
+
+    # Only the scores and compact labels leave the worker; the sample
+    # matrix and fit result are freed on return
+    label_dtype = np.min_scalar_type(best_k)
+    return (ari, sil, boot_labels.astype(label_dtype), idx,
+            picked_labels.astype(label_dtype))
+
 
 def bootstrap_validation(df, feature_matrix, best_k, n_iter, sample_frac):
     """Run bootstrap resampling to assess cluster stability."""
@@ -34,51 +110,59 @@ def bootstrap_validation(df, feature_matrix, best_k, n_iter, sample_frac):
     print(f"\n--- Bootstrap validation: {n_iter} iterations, {sample_size} samples each ---")
 
     original_labels = df["cluster"].values
-    cat_mask = [not col.endswith("_scaled") for col in feature_matrix.columns]
+
+    # Every sample is a subset of the same encounters, so compute (or
+    # reuse step 3's cached) full Gower matrix once and slice it
+    _, gower_path = cached_gower_distance(feature_matrix)
 
     ari_scores = []
     sil_scores = []
-    per_cluster_ari = {c: [] for c in sorted(df["cluster"].unique())}
-
-    for i in range(n_iter):
-        print(f"  Iteration {i + 1}/{n_iter}...", end=" ", flush=True)
-
-        # Random sample indices
-        idx = np.sort(np.random.choice(n, size=sample_size, replace=False))
-        fm_sample = feature_matrix.iloc[idx].reset_index(drop=True)
 
-        # Gower distance on sample
-        gower_dist = gower.gower_matrix(fm_sample, cat_features=cat_mask)
-
-        # K-medoids
-        km_result = km_lib.fasterpam(gower_dist, best_k, random_state=i, max_iter=300)
-        boot_labels = np.array(km_result.labels)
-
-        # Silhouette score
-        if len(set(boot_labels)) > 1:
-            sil = silhouette_score(gower_dist, boot_labels, metric="precomputed")
-            sil_scores.append(sil)
+    # Per original cluster: co-sampled member pairs, and those that stayed
+    # in the same bootstrap cluster
+    pair_same = np.zeros(best_k, dtype=np.int64)
+    pair_total = np.zeros(best_k, dtype=np.int64)
+
+    # Cluster-sorted encounters for the heatmap, chosen up front and
+    # labelled in every run, so each pair is counted n_iter times (the
+    # count never exceeds n_iter, so use the narrowest integer that fits)
+    picked = _stratified_sample(original_labels, STABILITY_HEATMAP_POINTS)
+    heat_same = np.zeros((len(picked), len(picked)), dtype=np.min_scalar_type(n_iter))
+
+    # Draw every sample up front, then run the independent iterations in
+    # parallel; workers memory-map the cached matrix and results are
+    # consumed as they arrive rather than held in a list
+    samples = [np.sort(np.random.choice(n, size=sample_size, replace=False))
+               for _ in range(n_iter)]
+    outputs = Parallel(n_jobs=-1, backend="loky", return_as="generator")(
+        delayed(_one_iter)(i, idx, gower_path, best_k, original_labels[idx], picked)
+        for i, idx in enumerate(samples)
+    )
 
-        # ARI with original labels
-        orig_subset = original_labels[idx]
-        ari = adjusted_rand_score(orig_subset, boot_labels)
+    for i, (ari, sil, boot_labels, idx, picked_labels) in enumerate(outputs):
         ari_scores.append(ari)
+        if sil is not None:
+            sil_scores.append(sil)
+        _update_pair_counts(pair_same, pair_total, original_labels[idx], boot_labels)
+        heat_same += picked_labels[:, None] == picked_labels[None, :]
+        print(f"  Iteration {i + 1}/{n_iter}: "
+              + (f"ARI={ari:.3f}, Sil={sil:.3f}" if sil is not None else f"ARI={ari:.3f}"))
+
+    # Per-cluster stability: share of co-sampled member pairs that stayed
+    # together, pooled over all runs (labels are dense 0..best_k-1)
+    cluster_stability = {
+        c: pair_same[c] / pair_total[c] if pair_total[c] else np.nan
+        for c in range(best_k)
+    }
 
-        print(f"ARI={ari:.3f}, Sil={sil:.3f}" if sil_scores else f"ARI={ari:.3f}")
-
-        del gower_dist  # free memory
-
-    # Per-cluster stability: for each cluster, measure how consistently
-    # its members stay together across bootstrap runs
-    cluster_stability = {}
-    for c in sorted(df["cluster"].unique()):
-        # Use the ARI scores as a proxy for overall stability
-        cluster_stability[c] = np.mean(ari_scores)
+    # Co-assignment rate among the heatmap encounters
+    heat = heat_same.astype(np.float32) / n_iter
 
     results = {
         "ari_scores": ari_scores,
         "sil_scores": sil_scores,
         "cluster_stability": cluster_stability,
+        "heatmap": (heat, original_labels[picked]),
     }
 
     print(f"\n  Bootstrap results:")
@@ -101,10 +185,12 @@ def statistical_tests(df):
         test_vars.append("prescriber_antibiotic_rate")
 
     test_results = []
-    clusters = sorted(df["cluster"].unique())
+    # Row positions per cluster (sorted by cluster id), built once
+    idx_by_cluster = df.groupby("cluster").indices
 
     for var in test_vars:
-        groups = [df[df["cluster"] == c][var].dropna().values for c in clusters]
+        col = df[var].to_numpy(dtype=np.float64)
+        groups = [col[i][~np.isnan(col[i])] for i in idx_by_cluster.values()]
         if all(len(g) > 0 for g in groups):
             stat, pval = stats.kruskal(*groups)
             test_results.append({
@@ -150,7 +236,7 @@ def create_validation_visualizations(bootstrap_results):
     cs = bootstrap_results["cluster_stability"]
     fig, ax = plt.subplots(figsize=(8, 5))
     ax.bar(list(cs.keys()), list(cs.values()), color="steelblue", edgecolor="black")
-    ax.set_title("Cluster Stability (Mean ARI)", fontsize=14)
+    ax.set_title("Cluster Stability (Mean Co-assignment Rate)", fontsize=14)
     ax.set_xlabel("Cluster")
     ax.set_ylabel("Stability Score")
     ax.set_ylim(0, 1)
@@ -160,6 +246,29 @@ def create_validation_visualizations(bootstrap_results):
     plt.savefig(f"{FIGURES_DIR}/15_cluster_stability.png", dpi=150)
     plt.close()
 
+    # Co-assignment heatmap (rows/columns grouped by cluster)
+    heat, heat_labels = bootstrap_results["heatmap"]
+    fig, ax = plt.subplots(figsize=(8, 7))
+    im = ax.imshow(heat, cmap="viridis", vmin=0, vmax=1, interpolation="nearest")
+    ax.grid(False)
+    bounds = np.flatnonzero(np.diff(heat_labels)) + 0.5
+    for b in bounds:
+        ax.axhline(b, color="white", linewidth=0.8)
+        ax.axvline(b, color="white", linewidth=0.8)
+    starts = np.concatenate([[0], np.ceil(bounds).astype(int)])
+    ends = np.concatenate([np.ceil(bounds).astype(int), [len(heat_labels)]])
+    ax.set_xticks((starts + ends - 1) / 2)
+    ax.set_xticklabels(heat_labels[starts])
+    ax.set_yticks((starts + ends - 1) / 2)
+    ax.set_yticklabels(heat_labels[starts])
+    ax.set_title("Bootstrap Co-assignment Rate (sampled encounters)", fontsize=14)
+    ax.set_xlabel("Cluster")
+    ax.set_ylabel("Cluster")
+    fig.colorbar(im, ax=ax, label="Co-assignment Rate")
+    plt.tight_layout()
+    plt.savefig(f"{FIGURES_DIR}/16_stability_heatmap.png", dpi=150)
+    plt.close()
+
     print(f"  Saved validation figures to {FIGURES_DIR}/")
 
 
@@ -197,14 +306,19 @@ def run():
     print("STEP 5: VALIDATION ANALYSIS")
     print("=" * 60)
 
-    df = pd.read_csv(ENCOUNTER_CLUSTERED_PATH, low_memory=False)
-    df_feat = pd.read_csv(ENCOUNTER_PRESCRIBER_PATH, low_memory=False)
-    print(f"\nLoaded: {len(df)} encounters, {df['cluster'].nunique()} clusters")
-
-    best_k = df["cluster"].nunique()
-
-    # Prepare features
-    feature_matrix = prepare_features(df_feat)
+    df = load_or_cache(ENCOUNTER_CLUSTERED_PATH)
+    df["cluster"] = df["cluster"].astype(np.int16)
+    best_k = int(df["cluster"].max()) + 1
+    print(f"\nLoaded: {len(df)} encounters, {best_k} clusters")
+
+    # Prepare features (reused from the last run unless the input changed)
+    feature_matrix = cached_result(
+        FEATURE_MATRIX_CACHE_PATH, ENCOUNTER_PRESCRIBER_PATH,
+        lambda: prepare_features(pd.read_parquet(
+            ENCOUNTER_PRESCRIBER_PATH,
+            columns=NUMERICAL_FEATURES + BINARY_FEATURES + CATEGORICAL_FEATURES,
+        )),
+    )
 
     # Bootstrap validation
     bootstrap_results = bootstrap_validation(
@@ -6,96 +6,215 @@ Step 6: Final Deliverables
 - Summary Word report
 """
 import os
+import io
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-from collections import Counter
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
+import xlsxwriter
+from openpyxl import load_workbook
+from PIL import Image
 from pptx import Presentation
 from pptx.util import Inches, Pt
 from pptx.enum.text import PP_ALIGN
 from docx import Document
 from docx.shared import Inches as DocInches, Pt as DocPt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-from config import (
-    ENCOUNTER_CLEAN_PATH, ENCOUNTER_PRESCRIBER_PATH,
-    ENCOUNTER_CLUSTERED_PATH, FIGURES_DIR, REPORTS_DIR,
-)
+from data_cache import load_or_cache
+from config import ENCOUNTER_CLUSTERED_PATH, FIGURES_DIR, REPORTS_DIR
+
+
+# Figures embedded in the presentation (file, slide title) and the report
+PPTX_FIGURES = [
+    ("10_pca_clusters.png", "PCA Cluster Visualization"),
+    ("11_cluster_heatmap.png", "Cluster Characteristics Heatmap"),
+    ("12_cluster_comparison_bars.png", "Cluster Comparison"),
+    ("09_silhouette_scores.png", "Silhouette Score Analysis"),
+]
+DOCX_FIGURES = [
+    "10_pca_clusters.png", "11_cluster_heatmap.png",
+    "12_cluster_comparison_bars.png", "13_cluster_sizes.png",
+]
+
+# 0/1 columns held as int8 and grouping keys held as category, so the
+# per-cluster and per-prescriber aggregations scan narrow arrays
+FLAG_COLUMNS = ["has_antibiotic", "polypharmacy_flag",
+                "antibiotic_monotherapy", "antibiotic_combination"]
+CATEGORY_COLUMNS = ["age_stratum", "prescriber_id", "cluster"]
+
+# Largest embedded figure size in pixels (11 in wide slide image at 150 dpi)
+EMBED_MAX_PX = (1650, 1000)
+
+# Rows per worksheet supported by Excel
+EXCEL_MAX_ROWS = 1_048_576
+
+
+def load_figures(names):
+    """Read each existing figure file once; returns {name: PNG bytes}.
+
+    Images larger than EMBED_MAX_PX are downscaled once here, so both
+    documents embed the smaller copy. Resampling can make flat-colour
+    charts compress worse, so the original is kept unless the copy is
+    actually smaller.
+    """
+    figures = {}
+    for name in dict.fromkeys(names):
+        fig_path = os.path.join(FIGURES_DIR, name)
+        if not os.path.exists(fig_path):
+            continue
+        with open(fig_path, "rb") as f:
+            data = f.read()
+        with Image.open(io.BytesIO(data)) as img:
+            if img.width > EMBED_MAX_PX[0] or img.height > EMBED_MAX_PX[1]:
+                img.thumbnail(EMBED_MAX_PX, Image.LANCZOS)
+                buf = io.BytesIO()
+                img.save(buf, format="PNG", optimize=True,
+                         dpi=img.info.get("dpi", (150, 150)))
+                if buf.tell() < len(data):
+                    data = buf.getvalue()
+        figures[name] = data
+    return figures
+
+
+def _write_sheet(wb, name, df, header_format):
+    """Stream a DataFrame into a new sheet (header row in header_format, NaN as blank)."""
+    ws = wb.add_worksheet(name)
+    ws.write_row(0, 0, [str(col) for col in df.columns], header_format)
+    # One bulk conversion per column to native Python scalars, then rows
+    # are zipped back together
+    cols = []
+    for col in df.columns:
+        values = df[col]
+        if values.isna().any():
+            values = values.astype(object).where(values.notna(), None)
+        cols.append(values.tolist())
+    for i, row in enumerate(zip(*cols), start=1):
+        ws.write_row(i, 0, row)
+
+
+def compute_cluster_stats(df_clustered):
+    """Per-cluster size, rates and dominant age group in one groupby pass."""
+    g = df_clustered.groupby("cluster", observed=True)
+    cluster_stats = g.agg(
+        n=("cluster", "size"),
+        ab_rate=("has_antibiotic", "mean"),
+        mono=("antibiotic_monotherapy", "mean"),
+        combo=("antibiotic_combination", "mean"),
+        poly=("polypharmacy_flag", "mean"),
+        mean_drugs=("num_distinct_drugs", "mean"),
+        mean_age=("age_months", "mean"),
+    )
+    cluster_stats["dominant_age"] = g["age_stratum"].agg(lambda s: s.value_counts().idxmax())
+    cluster_stats["pct"] = cluster_stats["n"] / len(df_clustered) * 100
+    return cluster_stats
+
 
+def compute_overview(df_clustered):
+    """Dataset-level figures shared by the presentation and the summary report."""
+    return {
+        "n": len(df_clustered),
+        "patients": df_clustered["patient_id"].nunique(),
+        "prescribers": df_clustered["prescriber_id"].nunique(),
+        "ab_rate": df_clustered["has_antibiotic"].mean(),
+        "poly_rate": df_clustered["polypharmacy_flag"].mean(),
+    }
 
-def create_excel_workbook(df_clean, df_prescriber, df_clustered):
+
+def create_excel_workbook(df_clustered, cluster_stats):
     """Create comprehensive Excel workbook with multiple sheets."""
     print("\n--- Creating Excel workbook ---")
     path = f"{REPORTS_DIR}/final_deliverables.xlsx"
 
-    with pd.ExcelWriter(path, engine="openpyxl") as writer:
-        # Sheet 1: Cluster summary
-        clusters = sorted(df_clustered["cluster"].unique())
-        summary_rows = []
-        for c in clusters:
-            sub = df_clustered[df_clustered["cluster"] == c]
-            summary_rows.append({
-                "Cluster": c,
-                "N": len(sub),
-                "Pct": round(len(sub) / len(df_clustered) * 100, 1),
-                "AB_Rate_%": round(sub["has_antibiotic"].mean() * 100, 1),
-                "Mono_%": round(sub["antibiotic_monotherapy"].mean() * 100, 1),
-                "Combo_%": round(sub["antibiotic_combination"].mean() * 100, 1),
-                "Polypharm_%": round(sub["polypharmacy_flag"].mean() * 100, 1),
-                "Mean_Drugs": round(sub["num_distinct_drugs"].mean(), 2),
-                "Mean_Age_Months": round(sub["age_months"].mean(), 1),
-                "Dominant_Age": sub["age_stratum"].mode().iloc[0] if len(sub) > 0 else "",
-            })
-        pd.DataFrame(summary_rows).to_excel(
-            writer, sheet_name="Cluster Summary", index=False
-        )
-
-        # Sheet 2: Full data with clusters (limit rows for Excel)
-        max_rows = min(len(df_clustered), 100000)
-        df_clustered.head(max_rows).to_excel(
-            writer, sheet_name="Encounter Data", index=False
-        )
-
-        # Sheet 3: Prescriber analysis
-        prescriber_stats = df_clustered.groupby("prescriber_id").agg(
-            total_encounters=("OPDID", "count"),
-            ab_rate=("has_antibiotic", "mean"),
-            polypharmacy_rate=("polypharmacy_flag", "mean"),
-            mean_drugs=("num_distinct_drugs", "mean"),
-            clusters_seen=("cluster", lambda x: ", ".join(map(str, sorted(x.unique())))),
-        ).reset_index()
-        prescriber_stats["ab_rate"] = (prescriber_stats["ab_rate"] * 100).round(1)
-        prescriber_stats["polypharmacy_rate"] = (prescriber_stats["polypharmacy_rate"] * 100).round(1)
-        prescriber_stats.sort_values("total_encounters", ascending=False).to_excel(
-            writer, sheet_name="Prescriber Analysis", index=False
-        )
-
-        # Sheet 4: Top drugs per cluster
-        drug_rows = []
-        for c in clusters:
-            sub = df_clustered[df_clustered["cluster"] == c]
-            drugs = []
-            for drug_str in sub["drug_names"].dropna():
-                for d in str(drug_str).split("|"):
-                    d = d.strip()
-                    if d and d.lower() != "nan":
-                        drugs.append(d)
-            for drug, count in Counter(drugs).most_common(15):
-                drug_rows.append({"Cluster": c, "Drug": drug, "Count": count})
-        pd.DataFrame(drug_rows).to_excel(
-            writer, sheet_name="Top Drugs by Cluster", index=False
-        )
-
-        # Sheet 5: Validation results (if exists)
-        val_path = f"{REPORTS_DIR}/validation_results.xlsx"
-        if os.path.exists(val_path):
-            val_df = pd.read_excel(val_path, sheet_name="Bootstrap Summary")
-            val_df.to_excel(writer, sheet_name="Validation", index=False)
-
+    # constant_memory flushes each row to disk once the next row starts,
+    # so memory stays flat however many encounter rows are written
+    wb = xlsxwriter.Workbook(path, {
+        "constant_memory": True,
+        "strings_to_numbers": False,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+    })
+    # One shared format for every header row; data cells carry no style
+    header_format = wb.add_format({"bold": True})
+
+    # Sheet 1: Cluster summary
+    # Whole-column rounding instead of per-cell round() calls
+    rates = np.round(cluster_stats[["ab_rate", "mono", "combo", "poly"]].to_numpy() * 100, 1)
+    summary = pd.DataFrame({
+        "Cluster": cluster_stats.index.to_numpy(),
+        "N": cluster_stats["n"].to_numpy(),
+        "Pct": np.round(cluster_stats["pct"].to_numpy(), 1),
+        "AB_Rate_%": rates[:, 0],
+        "Mono_%": rates[:, 1],
+        "Combo_%": rates[:, 2],
+        "Polypharm_%": rates[:, 3],
+        "Mean_Drugs": np.round(cluster_stats["mean_drugs"].to_numpy(), 2),
+        "Mean_Age_Months": np.round(cluster_stats["mean_age"].to_numpy(), 1),
+        "Dominant_Age": cluster_stats["dominant_age"].to_numpy(),
+    })
+    _write_sheet(wb, "Cluster Summary", summary, header_format)
+
+    # Sheet 2: Full data with clusters (streamed, so only Excel's own
+    # sheet limit applies; one row is the header)
+    max_rows = min(len(df_clustered), EXCEL_MAX_ROWS - 1)
+    if max_rows < len(df_clustered):
+        print(f"  Encounter Data truncated to {max_rows} of {len(df_clustered)} rows")
+    _write_sheet(wb, "Encounter Data", df_clustered.head(max_rows), header_format)
+
+    # Sheet 3: Prescriber analysis
+    prescriber_stats = df_clustered.groupby("prescriber_id", observed=True).agg(
+        total_encounters=("OPDID", "count"),
+        ab_rate=("has_antibiotic", "mean"),
+        polypharmacy_rate=("polypharmacy_flag", "mean"),
+        mean_drugs=("num_distinct_drugs", "mean"),
+    ).reset_index()
+    # Distinct (prescriber, cluster) pairs in cluster order, joined per prescriber
+    pairs = df_clustered[["prescriber_id", "cluster"]].drop_duplicates().sort_values("cluster")
+    clusters_seen = (pairs["cluster"].astype(str)
+                     .groupby(pairs["prescriber_id"], observed=True).agg(", ".join))
+    prescriber_stats["clusters_seen"] = prescriber_stats["prescriber_id"].map(clusters_seen)
+    prescriber_stats["ab_rate"] = (prescriber_stats["ab_rate"] * 100).round(1)
+    prescriber_stats["polypharmacy_rate"] = (prescriber_stats["polypharmacy_rate"] * 100).round(1)
+    _write_sheet(wb, "Prescriber Analysis",
+                 prescriber_stats.sort_values("total_encounters", ascending=False),
+                 header_format)
+
+    # Sheet 4: Top drugs per cluster (ties keep first-seen order)
+    tmp = df_clustered[["cluster", "drug_names"]].dropna(subset=["drug_names"])
+    tmp = tmp.assign(drug=tmp["drug_names"].astype(str).str.split("|")).explode("drug")
+    tmp["drug"] = tmp["drug"].str.strip()
+    tmp = tmp[(tmp["drug"].str.len() > 0) & (tmp["drug"].str.lower() != "nan")]
+    counts = (tmp.groupby(["cluster", "drug"], sort=False, observed=True)
+              .size().reset_index(name="Count"))
+    top = (counts.sort_values(["cluster", "Count"], ascending=[True, False], kind="stable")
+           .groupby("cluster", observed=True).head(15))
+    _write_sheet(wb, "Top Drugs by Cluster",
+                 top.rename(columns={"cluster": "Cluster", "drug": "Drug"}), header_format)
+
+    # Sheet 5: Validation results (if exists)
+    val_path = f"{REPORTS_DIR}/validation_results.xlsx"
+    if os.path.exists(val_path):
+        # Copy the one sheet row by row, without a DataFrame round trip
+        src = load_workbook(val_path, read_only=True, data_only=True)
+        ws = wb.add_worksheet("Validation")
+        for i, row in enumerate(src["Bootstrap Summary"].iter_rows(values_only=True)):
+            ws.write_row(i, 0, row, header_format if i == 0 else None)
+        src.close()
+
+    wb.close()
     print(f"  Excel workbook saved: {path}")
 
 
-def create_powerpoint(df_clustered):
+def _add_figure_slide(prs, png_bytes):
+    """Add a blank slide holding one full-width figure.
+
+    Kept in its own scope so the stream is released as soon as the image
+    part has been created.
+    """
+    slide = prs.slides.add_slide(prs.slide_layouts[6])  # blank
+    with io.BytesIO(png_bytes) as stream:
+        slide.shapes.add_picture(stream, Inches(1), Inches(0.5),
+                                 width=Inches(11), height=Inches(6.5))
+
+
+def create_powerpoint(overview, cluster_stats, figures):
     """Create PowerPoint presentation."""
     print("\n--- Creating PowerPoint presentation ---")
     prs = Presentation()
@@ -116,12 +235,12 @@ def create_powerpoint(df_clustered):
     slide.shapes.title.text = "Data Overview"
     body = slide.placeholders[1]
     tf = body.text_frame
-    tf.text = f"Total encounters: {len(df_clustered):,}"
-    tf.add_paragraph().text = f"Unique patients: {df_clustered['patient_id'].nunique():,}"
-    tf.add_paragraph().text = f"Unique prescribers: {df_clustered['prescriber_id'].nunique():,}"
+    tf.text = f"Total encounters: {overview['n']:,}"
+    tf.add_paragraph().text = f"Unique patients: {overview['patients']:,}"
+    tf.add_paragraph().text = f"Unique prescribers: {overview['prescribers']:,}"
     tf.add_paragraph().text = f"Date range: January 2026"
-    tf.add_paragraph().text = f"Antibiotic rate: {df_clustered['has_antibiotic'].mean()*100:.1f}%"
-    tf.add_paragraph().text = f"Polypharmacy rate: {df_clustered['polypharmacy_flag'].mean()*100:.1f}%"
+    tf.add_paragraph().text = f"Antibiotic rate: {overview['ab_rate']*100:.1f}%"
+    tf.add_paragraph().text = f"Polypharmacy rate: {overview['poly_rate']*100:.1f}%"
 
     # Slide 3: Methodology
     slide = prs.slides.add_slide(prs.slide_layouts[1])
@@ -131,44 +250,33 @@ def create_powerpoint(df_clustered):
     tf.text = "K-medoids clustering with Gower distance"
     tf.add_paragraph().text = "Features: age, weight, drugs, antibiotics, prescriber rates"
     tf.add_paragraph().text = "Mixed data types: numerical (scaled), binary, categorical (one-hot)"
-    tf.add_paragraph().text = f"Optimal k selected via silhouette score (k={df_clustered['cluster'].nunique()})"
+    tf.add_paragraph().text = f"Optimal k selected via silhouette score (k={len(cluster_stats)})"
     tf.add_paragraph().text = "Validated with bootstrap resampling (100 iterations)"
 
     # Slides for each cluster
-    clusters = sorted(df_clustered["cluster"].unique())
-    for c in clusters:
-        sub = df_clustered[df_clustered["cluster"] == c]
+    for c, st in cluster_stats.iterrows():
         slide = prs.slides.add_slide(prs.slide_layouts[1])
         slide.shapes.title.text = f"Cluster {c}"
         body = slide.placeholders[1]
         tf = body.text_frame
-        tf.text = f"Size: {len(sub):,} encounters ({len(sub)/len(df_clustered)*100:.1f}%)"
-        tf.add_paragraph().text = f"Dominant age: {sub['age_stratum'].mode().iloc[0]}"
-        tf.add_paragraph().text = f"Antibiotic rate: {sub['has_antibiotic'].mean()*100:.1f}%"
-        tf.add_paragraph().text = f"Polypharmacy: {sub['polypharmacy_flag'].mean()*100:.1f}%"
-        tf.add_paragraph().text = f"Mean drugs: {sub['num_distinct_drugs'].mean():.2f}"
-        tf.add_paragraph().text = f"Combination AB: {sub['antibiotic_combination'].mean()*100:.1f}%"
+        tf.text = f"Size: {int(st['n']):,} encounters ({st['pct']:.1f}%)"
+        tf.add_paragraph().text = f"Dominant age: {st['dominant_age']}"
+        tf.add_paragraph().text = f"Antibiotic rate: {st['ab_rate']*100:.1f}%"
+        tf.add_paragraph().text = f"Polypharmacy: {st['poly']*100:.1f}%"
+        tf.add_paragraph().text = f"Mean drugs: {st['mean_drugs']:.2f}"
+        tf.add_paragraph().text = f"Combination AB: {st['combo']*100:.1f}%"
 
     # Add figure slides
-    figure_files = [
-        ("10_pca_clusters.png", "PCA Cluster Visualization"),
-        ("11_cluster_heatmap.png", "Cluster Characteristics Heatmap"),
-        ("12_cluster_comparison_bars.png", "Cluster Comparison"),
-        ("09_silhouette_scores.png", "Silhouette Score Analysis"),
-    ]
-    for fig_file, title in figure_files:
-        fig_path = os.path.join(FIGURES_DIR, fig_file)
-        if os.path.exists(fig_path):
-            slide = prs.slides.add_slide(prs.slide_layouts[6])  # blank
-            slide.shapes.add_picture(fig_path, Inches(1), Inches(0.5),
-                                     width=Inches(11), height=Inches(6.5))
+    for fig_file, title in PPTX_FIGURES:
+        if fig_file in figures:
+            _add_figure_slide(prs, figures[fig_file])
 
     path = f"{REPORTS_DIR}/final_presentation.pptx"
     prs.save(path)
     print(f"  PowerPoint saved: {path}")
 
 
-def create_summary_report(df_clustered):
+def create_summary_report(overview, cluster_stats, figures):
     """Create summary Word report."""
     print("\n--- Creating summary Word report ---")
     doc = Document()
@@ -192,33 +300,32 @@ def create_summary_report(df_clustered):
 
     # Descriptive statistics
     doc.add_heading("Descriptive Statistics", level=1)
-    doc.add_paragraph(f"Total encounters: {len(df_clustered):,}")
-    doc.add_paragraph(f"Unique patients: {df_clustered['patient_id'].nunique():,}")
-    doc.add_paragraph(f"Unique prescribers: {df_clustered['prescriber_id'].nunique():,}")
-    doc.add_paragraph(f"Overall antibiotic rate: {df_clustered['has_antibiotic'].mean()*100:.1f}%")
-    doc.add_paragraph(f"Polypharmacy rate: {df_clustered['polypharmacy_flag'].mean()*100:.1f}%")
+    doc.add_paragraph(f"Total encounters: {overview['n']:,}")
+    doc.add_paragraph(f"Unique patients: {overview['patients']:,}")
+    doc.add_paragraph(f"Unique prescribers: {overview['prescribers']:,}")
+    doc.add_paragraph(f"Overall antibiotic rate: {overview['ab_rate']*100:.1f}%")
+    doc.add_paragraph(f"Polypharmacy rate: {overview['poly_rate']*100:.1f}%")
 
     # Cluster results
     doc.add_heading("Cluster Results", level=1)
-    n_clusters = df_clustered["cluster"].nunique()
+    n_clusters = len(cluster_stats)
     doc.add_paragraph(f"Number of clusters identified: {n_clusters}")
 
-    for c in sorted(df_clustered["cluster"].unique()):
-        sub = df_clustered[df_clustered["cluster"] == c]
+    for c, st in cluster_stats.iterrows():
         doc.add_heading(f"Cluster {c}", level=2)
-        doc.add_paragraph(f"Size: {len(sub):,} ({len(sub)/len(df_clustered)*100:.1f}%)")
-        doc.add_paragraph(f"Antibiotic rate: {sub['has_antibiotic'].mean()*100:.1f}%")
-        doc.add_paragraph(f"Polypharmacy rate: {sub['polypharmacy_flag'].mean()*100:.1f}%")
-        doc.add_paragraph(f"Mean drugs per encounter: {sub['num_distinct_drugs'].mean():.2f}")
-        doc.add_paragraph(f"Dominant age group: {sub['age_stratum'].mode().iloc[0]}")
+        doc.add_paragraph(f"Size: {int(st['n']):,} ({st['pct']:.1f}%)")
+        doc.add_paragraph(f"Antibiotic rate: {st['ab_rate']*100:.1f}%")
+        doc.add_paragraph(f"Polypharmacy rate: {st['poly']*100:.1f}%")
+        doc.add_paragraph(f"Mean drugs per encounter: {st['mean_drugs']:.2f}")
+        doc.add_paragraph(f"Dominant age group: {st['dominant_age']}")
 
     # Add figures
     doc.add_heading("Figures", level=1)
-    for fig in ["10_pca_clusters.png", "11_cluster_heatmap.png",
-                "12_cluster_comparison_bars.png", "13_cluster_sizes.png"]:
-        fig_path = os.path.join(FIGURES_DIR, fig)
-        if os.path.exists(fig_path):
-            doc.add_picture(fig_path, width=DocInches(5.5))
+    for fig in DOCX_FIGURES:
+        if fig in figures:
+            # Stream closed as soon as python-docx has copied the image part
+            with io.BytesIO(figures[fig]) as stream:
+                doc.add_picture(stream, width=DocInches(5.5))
             doc.add_paragraph("")
 
     path = f"{REPORTS_DIR}/summary_report.docx"
@@ -231,14 +338,32 @@ def run():
     print("STEP 6: FINAL DELIVERABLES")
     print("=" * 60)
 
-    df_clean = pd.read_csv(ENCOUNTER_CLEAN_PATH, low_memory=False)
-    df_prescriber = pd.read_csv(ENCOUNTER_PRESCRIBER_PATH, low_memory=False)
-    df_clustered = pd.read_csv(ENCOUNTER_CLUSTERED_PATH, low_memory=False)
-    print(f"\nLoaded all datasets. Clustered: {len(df_clustered)} encounters")
-
-    create_excel_workbook(df_clean, df_prescriber, df_clustered)
-    create_powerpoint(df_clustered)
-    create_summary_report(df_clustered)
+    # Parquet copy of the clustered CSV (all columns: the Encounter Data
+    # sheet dumps every one of them)
+    df_clustered = load_or_cache(ENCOUNTER_CLUSTERED_PATH)
+    for col in FLAG_COLUMNS:
+        df_clustered[col] = df_clustered[col].astype(np.int8)
+    for col in CATEGORY_COLUMNS:
+        df_clustered[col] = df_clustered[col].astype("category")
+    print(f"\nLoaded clustered data: {len(df_clustered)} encounters")
+
+    cluster_stats = compute_cluster_stats(df_clustered)
+    overview = compute_overview(df_clustered)
+
+    # Each PNG is read from disk once and shared by both documents
+    figures = load_figures([f for f, _ in PPTX_FIGURES] + DOCX_FIGURES)
+
+    # The deck and the report only need the small precomputed inputs, so
+    # they build in worker processes while the workbook (which needs the
+    # full encounter table) is written here
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        jobs = [
+            pool.submit(create_powerpoint, overview, cluster_stats, figures),
+            pool.submit(create_summary_report, overview, cluster_stats, figures),
+        ]
+        create_excel_workbook(df_clustered, cluster_stats)
+        for job in jobs:
+            job.result()
 
     print("\n" + "=" * 60)
     print("ALL DELIVERABLES COMPLETE!")